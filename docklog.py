@@ -1,209 +1,322 @@
 #!/usr/bin/env python3
 
+import aiodocker
+import aiohttp
 import argparse
-import docker
+import asyncio
 import errno
+import heapq
+import itertools
+import math
 import os
+import queue
 import random
 import re
+import struct
 import sys
+import threading
 import time
-from colorama import init, deinit, Back, Style
-from multiprocessing import Process
-from signal import signal, SIGPIPE, SIG_DFL
+from signal import signal, SIGINT, SIGPIPE, SIG_DFL
+# ANSI sequences for bold text and resetting attributes
+BRIGHT = '\033[1m'
+RESET = '\033[0m'
+
 # Handle SIGPIPE from kb interrupts while grepping, etc.
 signal(SIGPIPE,SIG_DFL) 
 
-# Limit maximum container log streams to 8
-# TODO: tune this, measure impact on docker daemon
-def maximum_length(nmax):
-    class MaximumLength(argparse.Action):
-        def __call__(self, parser, args, values, option_string=None):
-            if not len(values) <= nmax:
-                msg='too many {} arguments: {}. Max 8'.format(self.dest,len(values))
-                raise argparse.ArgumentTypeError(msg)
-            setattr(args, self.dest, values)
-    return MaximumLength
+# Retrieve a container's logs as raw bytes
+# aiodocker's own log() decodes output to str, dropping bytes that aren't valid
+# UTF-8, and inspects the container again for its TTY flag. So query the logs
+# endpoint directly through the client's _query, an async context manager
+# since aiodocker 0.15. Non-TTY output is multiplexed into frames, each behind
+# an 8-byte header carrying the payload length; TTY output is sent as-is.
+async def log_chunks(docker, container, follow, timestamps, tail):
+    params = {'stdout': True, 'stderr': True, 'follow': follow, 'timestamps': timestamps, 'tail': tail}
+    # No timeout, as for log(); a followed stream stays open indefinitely
+    async with docker._query('containers/{}/logs'.format(container.id), params=params, timeout=None) as response:
+        content = response.content
+        if container['Config']['Tty']:
+            async for chunk in content.iter_any():
+                yield chunk
+            return
+        while True:
+            try:
+                header = await content.readexactly(8)
+                chunk = await content.readexactly(struct.unpack('>BxxxL', header)[1])
+            except asyncio.IncompleteReadError:
+                return
+            yield chunk
+
+# Reassemble a docker log stream into lines
+# Frames and TTY output chunks need not end on a line boundary, so buffer raw
+# bytes and yield each complete line.
+async def iter_lines(stream):
+    buf = bytearray()
+    async for chunk in stream:
+        buf += chunk
+        if b'\n' in chunk:
+            *lines, rest = buf.split(b'\n')
+            for line in lines:
+                yield line
+            buf = rest
+    # Output may end without a trailing newline
+    if buf:
+        yield buf
+
+# Build the colored, padded container name that starts each log line
+def make_prefix(name, color, namewidth, timestamps):
+    if timestamps:
+        return (color + name + RESET + ' ' * (namewidth - len(name) + 8)).encode()
+    return (color + name + RESET + ' ' * (namewidth - len(name) + 14) + '|  ').encode()
+
+# Build a per-line writer specialized for the timestamp mode, so the stream
+# loop does no branching or formatting of its own
+# Lines are queued as tuples of buffers for the writer thread to gather
+def make_writer(prefix, timestamps):
+    put = logqueue.put
+    if timestamps:
+        def write(line):
+            put((prefix, line[:22], b'Z  |  ', line[line.find(b' ') + 1:].rstrip(), b'\n'))
+    else:
+        def write(line):
+            put((prefix, line.rstrip(), b'\n'))
+    return write
 
 # Print a docker log stream
-def stream_log(container, color):
+async def stream_log(docker, container, prefix, timestamps, tail, writer, drained):
     # Retrieve log lines live as stream
-    # Decode (if needed), prepend formatting, and print
+    # Prepend pre-encoded formatting and queue for printing
+    write = make_writer(prefix, timestamps)
+    stream = log_chunks(docker, container, True, timestamps, tail)
+    # Report a lost stream without taking down the other containers' streams
+    try:
+        async for line in iter_lines(stream):
+            # Hold off while the writer thread is behind, e.g. stdout is stalled
+            # in a paused pager, until it signals that it made room
+            # Clear before rechecking so a wakeup in between is not lost;
+            # nothing awaits between the last check and the put
+            while logqueue.full():
+                if not writer.is_alive():
+                    return
+                drained.clear()
+                if logqueue.full():
+                    await drained.wait()
+            write(line)
+    except (aiodocker.DockerError, aiohttp.ClientError):
+        print('\n' + BRIGHT + '\033[31mError' + RESET + ': Lost log stream for container \'' + container['Name'].lstrip('/') + '\'', flush=True)
 
-    # Some containers return strings and some return byte streams; apparently
-    # this has to do with container TTY allocation (docker-py issue 1729). We'll
-    # attempt to decode, and if output is char strings then stitch the lines
-    # back together.
-    if args.timestamps:
-        try:
-            tabwidth = (bignamewidth - len(container.name)) + 8
-            strline = ''
-            for line in container.logs(stream=True, timestamps=True, tail=args.tail):
-                try:
-                    line = line.decode().strip()
-                    time = line.split()[0][:22] + 'Z'
-                    logline = ' '.join(line.split()[1:])
-                    print(color + container.name + Style.RESET_ALL + ' ' * tabwidth + time + '  |  ' + logline, flush=True)
-                except AttributeError:
-                    if not '\n' in line and not '\r' in line:
-                        strline += line
-                    if '\n' in line:
-                        time = strline.strip().split()[0][:22] + 'Z'
-                        logline = ' '.join(strline.strip().split()[1:])
-                        strline = ''
-                        print(color + container.name + Style.RESET_ALL + ' ' * tabwidth + time + '  |  ' + logline, flush=True)
-        except KeyboardInterrupt:
-            return 1
+# Write all buffers with writev, resubmitting the rest after short writes
+def writev_all(writev, iov):
+    while iov:
+        written = writev(iov)
+        i = 0
+        while i < len(iov) and written >= len(iov[i]):
+            written -= len(iov[i])
+            i += 1
+        iov = iov[i:]
+        if iov and written:
+            iov[0] = memoryview(iov[0])[written:]
+
+# Write queued log lines to stdout in batches
+# Gather up to bufsize bytes (and at most IOV_MAX buffers) per writev, then
+# wait if the queue ran dry
+# Stop after writing out everything queued before a None
+# On a write error, record it and set stop so the streams end
+def write_logs(bufsize, interval, loop, drained, stop):
+    global writeerror
+    fd = sys.stdout.fileno()
+    iovmax = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+
+    if hasattr(os, 'writev'):
+        writev = lambda iov: os.writev(fd, iov)
+    # No scatter-gather write on win32
     else:
+        writev = lambda iov: os.write(fd, b''.join(iov))
+    while True:
+        chunk = logqueue.get()
+        iov = []
+        size = 0
+        full = False
+        while chunk is not None:
+            iov.extend(chunk)
+            size += sum(map(len, chunk))
+            # Leave room for another queued line of up to 5 buffers
+            if size >= bufsize or len(iov) + 5 > iovmax:
+                full = True
+                break
+            try:
+                chunk = logqueue.get_nowait()
+            except queue.Empty:
+                break
+        # Wake any streams held off by a full queue
+        loop.call_soon_threadsafe(drained.set)
         try:
-            tabwidth = (bignamewidth - len(container.name)) + 14
-            strline = ''
-            for line in container.logs(stream=True, timestamps=False, tail=args.tail):
-                try:
-                    logline = line.decode().strip()
-                    print(color + container.name + Style.RESET_ALL + ' ' * tabwidth  + '|  ' + logline, flush=True)
-                except AttributeError:
-                    if not '\n' in line and not '\r' in line:
-                        strline += line
-                    if '\n' in line:
-                        logline = strline.strip()
-                        strline = ''
-                        print(color + container.name + Style.RESET_ALL + ' ' * tabwidth  + '|  ' + logline, flush=True)
-        except KeyboardInterrupt:
-            return 1
+            writev_all(writev, iov)
+        # stdout is gone or full, so nothing queued can be written
+        except OSError as error:
+            writeerror = error
+            loop.call_soon_threadsafe(stop.set)
+            return
+        if chunk is None:
+            return
+        if not full:
+            time.sleep(interval)
+
+# Retrieve last N log lines without streaming
+async def fetch_log(docker, container, timestamps, tail):
+    return b''.join([chunk async for chunk in log_chunks(docker, container, False, timestamps, tail)])
 
 # Print without streaming
-def print_log(container, color):
-    # Retrieve last N log lines and exit
-    # Decode, prepend formatting, and print
-    thislog = []
-    if args.timestamps:
-        try:
-            tabwidth = (bignamewidth - len(container.name)) + 8
-            for line in container.logs(stream=False, timestamps=True, tail=args.tail).decode().split('\n')[:-1]:
-                logline = line.strip()
-                time = logline.split()[0][:24] + 'Z'
-                logline = ' '.join(logline.split()[1:])
-                thislog.append(color + container.name + Style.RESET_ALL + ' ' * tabwidth  + time + '  |  ' + logline)
-            return thislog
-        except KeyboardInterrupt:
-            return 1
+def print_log(prefix, log, timestamps):
+    # Prepend formatting to fetched log lines and yield (timestamp, line) for merging
+    if timestamps:
+        for line in log.split(b'\n')[:-1]:
+            time = line[:24]
+            yield time, prefix + time + b'Z  |  ' + line[line.find(b' ') + 1:].rstrip() + b'\n'
     else:
+        for line in log.split(b'\n')[:-1]:
+            yield b'', prefix + line.rstrip() + b'\n'
+
+# Connect to docker, resolve containers, and print their logs
+async def main():
+    # Connect to docker using DOCKER_HOST env var
+    # One client is shared by every container lookup and log stream
+    try:
+        docker = aiodocker.Docker()
+    # Client setup fails in several ways, e.g. an AssertionError when
+    # DOCKER_HOST is unset and there is no local socket
+    except Exception:
+        print('\n' + BRIGHT + '\033[31mError' + RESET + ': Could not connect to docker daemon')
+        return 1
+
+    try:
         try:
-            tabwidth = (bignamewidth - len(container.name)) + 14
-            for line in container.logs(stream=False, timestamps=False, tail=args.tail).decode().split('\n')[:-1]:
-                thislog.append(color + container.name + Style.RESET_ALL + ' ' * tabwidth  + '|  ' + line.strip())
-            return thislog
-        except KeyboardInterrupt:
+            await docker.version()
+        except aiodocker.DockerError:
+            print('\n' + BRIGHT + '\033[31mError' + RESET + ': Could not connect to docker daemon')
             return 1
 
-# Parse arguments and options
-# Print error if too many containers
-parser = argparse.ArgumentParser(description='Simultaneously stream the logs of up to eight Docker containers')
-parser.add_argument('container', metavar='CONTAINER', help='Container names or IDs', type=str, nargs='+', action=maximum_length(8))
-parser.add_argument('-t', '--timestamps', '--time', help='Prepend timestamps to log lines', action='store_true')
-parser.add_argument('-n', '--tail', help='Number of lines to show from end (default 10)', type=int, default=10)
-parser.add_argument('-s', '--static', help='Do not follow; print tail lines and exit', action='store_true')
-try:
-    args = parser.parse_args()
-except argparse.ArgumentTypeError as err:
-    parser.print_usage()
-    print(os.path.basename(parser.prog) + ': ' + 'error: ' + str(err))
-    sys.exit(1)
-
-# Hold used colors and init ANSI sequences in win32
-usedcolors = []
-init(strip=False)
+        # Get container by name or ID from supplied command-line arguments
+        # Look them all up concurrently, once; names and the TTY flag come from
+        # this inspect data, and the logs endpoint is then queried by id
+        resolved = await asyncio.gather(*(docker.containers.get(container) for container in args.container), return_exceptions=True)
+        for container, lookup in zip(args.container, resolved):
+            if isinstance(lookup, aiodocker.DockerError) and lookup.status == 404:
+                print('\n' + BRIGHT + '\033[31mError' + RESET + ': Could not find container \'' + container + '\'')
+                return 1
+            if isinstance(lookup, BaseException):
+                raise lookup
+        names = [container['Name'].lstrip('/') for container in resolved]
 
-# Hold the largest container name char count
-bignamewidth = 0
+        # Hold the largest container name char count
+        bignamewidth = max(len(name) for name in names)
 
-# Hold our multiple clients
-clients = []
+        # Shuffle color codes for container names, normal colors before bright ones
+        # Reuse them in the same order if there are more containers than colors
+        colorcodes = itertools.cycle(random.sample(range(31,36), 5) + random.sample(range(91,96), 5))
 
-# Hold our log stream child processes
-streams = []
+        # Give each container the next color; colors repeat after 10 containers
+        prefixes = [make_prefix(name, BRIGHT + '\033[' + str(next(colorcodes)) + 'm', bignamewidth, args.timestamps) for name in names]
 
-# Hold static log lines for later sorting
-all_lines = []
+        # Fetch all logs concurrently, then print and exit if not streaming
+        if args.static:
+            fetched = await asyncio.gather(*(fetch_log(docker, container, args.timestamps, args.tail) for container in resolved))
+            formatted = [print_log(prefix, log, args.timestamps) for prefix, log in zip(prefixes, fetched)]
 
-# Test client connection, get names, find longest
-for container in args.container:
-    try:
-        client = docker.from_env(version='auto', assert_hostname=False)
-    except:
-        print('\n' + Style.BRIGHT + '\033[31mError' + Style.RESET_ALL + ': Could not connect to docker daemon')
-        deinit()
-        sys.exit(1)
-    try:
-        thiscontainer = client.containers.get(container)
-    except:
-        print('\n' + Style.BRIGHT + '\033[31mError' + Style.RESET_ALL + ': Could not find container '' + container + ''')
-        client.close()
-        deinit()
-        sys.exit(1)
-    
-    thislength = len(thiscontainer.name)
-    bignamewidth = thislength if thislength > bignamewidth else bignamewidth
-    client.close()
-
-
-# Get logs for each container
-for container in args.container:
-    # Always get a new color for container names
-    while True:
-        if len(usedcolors) >= 5:
-            colorcode = random.randrange(91,96)
+            # Each container's log is already in time order, so merge rather than sort
+            if args.timestamps:
+                lines = heapq.merge(*formatted, key=lambda log: log[0])
+            else:
+                lines = itertools.chain(*formatted)
+            for _, line in lines:
+                sys.stdout.buffer.write(line)
+        # Multiplex all log streams on this event loop until they end or ctrl-c
         else:
-            colorcode = random.randrange(31,36)
+            # Block until ctrl-c or a failed write sets stop; win32 falls back
+            # to KeyboardInterrupt
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
 
-        if not colorcode in usedcolors:
-            usedcolors.append(colorcode)
-            break
-    color = Style.BRIGHT + '\033[' + str(colorcode) + 'm'
+            # Write log output from a separate thread
+            drained = asyncio.Event()
+            writer = threading.Thread(target=write_logs, args=(args.log_buffer, args.log_flush, loop, drained, stop), daemon=True)
+            writer.start()
 
-    # Connect to docker using DOCKER_HOST env var
-    client = docker.from_env(version='auto', assert_hostname=False)
-    clients.append(client)
-    
-    # Get container by name or ID from supplied command-line arguments
-    resolved_container = client.containers.get(container)
-
-    # Get logs and hold for sorting if not streaming
-    if args.static:
-        all_lines.extend(print_log(resolved_container, color))
-    # Spawn child processes if streaming
-    # Do not block or buffer
-    else:
-        p = Process(target=stream_log, args=(resolved_container, color))
-        streams.append(p)
-        p.start()
-
-# Print, clean up, and exit if not streaming
-if args.static:
-    if args.timestamps:
-        for line in sorted(all_lines, key=lambda line: line.split()[1]):
-            print(line)
-    else:
-        for line in all_lines:
-            print(line)
-    client.close()
-    deinit()
-    print()
-    sys.exit()
-# Keep main thread alive while streaming, catch ctrl-c
-else:
-    try:
-        while True:
-            time.sleep(1)
-    # Clean up child processes and close docker client connections
-    except:
-        for stream in streams:
-            stream.terminate()
-        for client in clients:
-            client.close()
-    # De-colorize and exit
+            streams = asyncio.gather(*(stream_log(docker, container, prefix, args.timestamps, args.tail, writer, drained) for container, prefix in zip(resolved, prefixes)))
+            try:
+                loop.add_signal_handler(SIGINT, stop.set)
+                handled = True
+            except NotImplementedError:
+                handled = False
+            stopping = asyncio.ensure_future(stop.wait())
+            try:
+                await asyncio.wait([streams, stopping], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                stopping.cancel()
+                streams.cancel()
+                if handled:
+                    loop.remove_signal_handler(SIGINT)
+                # Write out anything still queued
+                # A dead writer leaves the queue full, so never block handing it the sentinel
+                while writer.is_alive():
+                    try:
+                        logqueue.put(None, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                writer.join()
+            try:
+                await streams
+            except asyncio.CancelledError:
+                pass
+            if writeerror is not None:
+                print('\n' + BRIGHT + '\033[31mError' + RESET + ': Could not write log output: ' + str(writeerror), file=sys.stderr)
+                return 1
+    # Close docker client connection
     finally:
-        deinit()
+        await docker.close()
+
+# Accept only finite numbers greater than zero for the output tunables
+def positive(type):
+    def parse(value):
+        value = type(value)
+        if not (value > 0 and math.isfinite(value)):
+            raise argparse.ArgumentTypeError('must be a finite number greater than zero: {}'.format(value))
+        return value
+    parse.__name__ = type.__name__
+    return parse
+
+# Parse arguments and options
+parser = argparse.ArgumentParser(description='Simultaneously stream the logs of multiple Docker containers')
+parser.add_argument('container', metavar='CONTAINER', help='Container names or IDs', type=str, nargs='+')
+parser.add_argument('-t', '--timestamps', '--time', help='Prepend timestamps to log lines', action='store_true')
+parser.add_argument('-n', '--tail', help='Number of lines to show from end (default 10)', type=int, default=10)
+parser.add_argument('-s', '--static', help='Do not follow; print tail lines and exit', action='store_true')
+parser.add_argument('--log-buffer', help='Bytes of log output to batch per write (default 4096)', type=positive(int), default=4096)
+parser.add_argument('--log-flush', help='Seconds between log output writes (default 0.2)', type=positive(float), default=0.2)
+args = parser.parse_args()
+
+# Enable ANSI sequences in the win32 console; other terminals understand them as-is
+# Log output bypasses sys.stdout, so turn on the console's own VT processing
+# rather than relying on colorama's stream wrapper
+if sys.platform == 'win32':
+    from colorama import just_fix_windows_console
+    just_fix_windows_console()
+
+# Hold encoded log lines from all streams for the writer thread
+# Bounded so a stalled stdout pushes back on the log streams
+logqueue = queue.Queue(maxsize=10000)
+
+# Set by the writer thread if writing log output to stdout fails
+writeerror = None
+
+# Run until done, catch ctrl-c
+try:
+    status = asyncio.run(main())
+except KeyboardInterrupt:
+    status = 0
+# Exit, skipping the final newline if stdout can no longer be written
+finally:
+    if writeerror is None:
         print()
-        sys.exit()
+sys.exit(status)